@@ -1,12 +1,18 @@
 import streamlit as st
-import cv2
-import numpy as np
+import hashlib
 import os
-import tempfile
 import yaml
 import gspread
-import time
 import bcrypt # Import bcrypt for hashing/checking passwords
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+
+from core import process_one_video, thumbnail_jpeg, warm_up
 
 # --- Streamlit App Interface (General Config) ---
 st.set_page_config(page_title="Ad Scene Capture Tool", layout="wide", page_icon="📸")
@@ -15,23 +21,36 @@ st.set_page_config(page_title="Ad Scene Capture Tool", layout="wide", page_icon=
 # --- Configuration from config.yaml ---
 # config.yaml now ONLY contains usernames and their hashed passwords.
 # No cookie info or preauthorized list needed here, as we manage cookies manually.
-try:
+@st.cache_resource(show_spinner=False)
+def load_config():
+    """Parses config.yaml once per process instead of on every rerun.
+    The returned dict is shared, so users added to it at registration can log in until the app restarts."""
     with open('config.yaml') as file:
-        config = yaml.load(file, Loader=yaml.SafeLoader) # <<< CORRECTED THIS LINE TO yaml.SafeLoader
+        return yaml.load(file, Loader=yaml.SafeLoader) # <<< CORRECTED THIS LINE TO yaml.SafeLoader
+
+try:
+    config = load_config()
 except FileNotFoundError:
     st.error("config.yaml not found. Please create it as per previous instructions.")
     st.stop()
 
 
 # --- Google Sheets Setup ---
-# Your existing Google Sheets setup remains the same.
-gc = None
+@st.cache_resource(show_spinner=False)
+def get_users_sheet():
+    """Authenticates and opens the users worksheet once per process instead of on every rerun.
+    Errors propagate (and so aren't cached)."""
+    gc = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
+    # The session already pools keep-alive connections (and now lives as long as the process);
+    # only add retries, so a dropped connection doesn't fail the request
+    gc.http_client.session.mount("https://", HTTPAdapter(max_retries=3))
+    spreadsheet = gc.open("introFrameAppUsers") 
+    return spreadsheet.worksheet("users")
+
 users_sheet = None
 
 try:
-    gc = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
-    spreadsheet = gc.open("introFrameAppUsers") 
-    users_sheet = spreadsheet.worksheet("users") 
+    users_sheet = get_users_sheet()
     
 except gspread.exceptions.SpreadsheetNotFound:
     st.error("Google Sheet 'introFrameAppUsers' not found. Please ensure the name is exact and the service account has access.")
@@ -51,44 +70,255 @@ except Exception as e:
 
 
 # --- Google Sheets Helper Functions ---
-def load_user_data_from_gsheets():
-    """Loads all user records from the Google Sheet into a dictionary."""
+logger = logging.getLogger(__name__)
+
+# Background sheet writes: longest wait between retries, and how many tries before giving up
+SHEET_RETRY_MAX_SEC = 60
+SHEET_WRITE_ATTEMPTS = 5
+
+def find_user_row(username):
+    """Returns the sheet row of `username`, or None. Only the username column is downloaded
+    (Worksheet.find would fetch the whole sheet). Row 1 is the header, so a user literally named
+    'username' doesn't match it."""
+    usernames = users_sheet.col_values(1)
+    # Sheet rows are 1-based and row 1 is the header, so list index i is row i + 1
+    return next((i + 1 for i, value in enumerate(usernames) if i > 0 and value == username), None)
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_user_row(username):
+    """Returns (row_index, row values) for `username`, or None if they have no row. Only the username
+    column and then that one row are downloaded; cached for a minute so reruns don't each hit the Sheets API.
+    Errors propagate (and so aren't cached)."""
+    row_index = find_user_row(username)
+    if row_index is None:
+        return None
+    return row_index, users_sheet.row_values(row_index)
+
+def load_current_user(username):
+    """Loads one user's record from the Google Sheet; returns None if they aren't in it yet."""
     try:
-        records = users_sheet.get_all_records()
-        user_data_dict = {}
-        for record in records:
-            try:
-                user_data_dict[record['username']] = {
-                    'uses_left': int(record['uses_left']),
-                    'is_paid': str(record['is_paid']).lower() == 'true',
-                    'email': record.get('email', '') # Ensure email is pulled if it exists
-                }
-            except (ValueError, KeyError) as e:
-                st.warning(f"Skipping malformed user record in Google Sheet: {record} - Error: {e}")
-                continue
-        return user_data_dict
+        found = fetch_user_row(username)
     except Exception as e:
         st.error(f"Error loading user data from Google Sheet: {e}")
-        return {}
+        return None
+    if found is None:
+        return None
+
+    row_index, values = found
+    # Remember the user's sheet row so saves don't have to search for it again
+    st.session_state.setdefault('_user_row_map', {})[username] = row_index
+    values = values + [''] * (4 - len(values)) # row_values drops trailing empty cells
+    try:
+        user_data = {
+            'uses_left': int(values[1]),
+            'is_paid': str(values[2]).lower() == 'true',
+            'email': values[3] # Column D, if it's filled in
+        }
+    except ValueError as e:
+        st.warning(f"Skipping malformed user record in Google Sheet: {values} - Error: {e}")
+        return None
+    # A usage change still waiting for the background writer takes precedence over the sheet
+    pending = get_sheet_writer()[1].get(username)
+    if pending is not None:
+        user_data['uses_left'], user_data['is_paid'] = pending
+    return user_data
 
 def save_user_data_to_gsheets(username, uses_left, is_paid, email):
     """Updates a user's data in the Google Sheet or appends if new."""
     try:
-        records = users_sheet.get_all_records()
-        usernames_list = [r['username'] for r in records]
-
-        if username in usernames_list:
-            row_index = usernames_list.index(username) + 2
-            users_sheet.update_cell(row_index, 2, uses_left) # uses_left is Column B
-            users_sheet.update_cell(row_index, 3, is_paid)   # is_paid is Column C
+        row_index = st.session_state.get('_user_row_map', {}).get(username)
+        if row_index is None:
+            # Not seen in this session's load; search the username column rather than downloading every record
+            row_index = find_user_row(username)
+
+        if row_index is not None:
+            # uses_left is Column B, is_paid is Column C: one range write instead of two update_cell calls
+            users_sheet.update(
+                range_name=f"B{row_index}:C{row_index}",
+                values=[[int(uses_left), bool(is_paid)]],
+                value_input_option="RAW",
+            )
             # Assuming 'email' is in Column D if you want to store it there later
             # users_sheet.update_cell(row_index, 4, email) 
         else:
             # New user, append a new row
-            users_sheet.append_row([username, uses_left, is_paid, email]) # Add email if you plan to store it
+            users_sheet.append_rows([[username, int(uses_left), bool(is_paid), email]], value_input_option="RAW")
+        fetch_user_row.clear(username) # This user's cached copy is now stale
     except Exception as e:
         st.error(f"Error saving user data to Google Sheet: {e}")
 
+def _is_transient_sheet_error(error):
+    """True for failures worth retrying: rate limits, server errors and dropped connections."""
+    if isinstance(error, gspread.exceptions.APIError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+def _write_usage_batch(latest):
+    """Writes {username: (row_index, uses_left, is_paid)} in one call; returns {username: exception} of failed writes.
+    If the batch fails, each update is retried on its own so one bad row doesn't sink the others."""
+    def write(updates):
+        users_sheet.batch_update(
+            [{"range": f"B{row_index}:C{row_index}", "values": [[int(uses_left), bool(is_paid)]]}
+             for row_index, uses_left, is_paid in updates],
+            value_input_option="RAW",
+        )
+    try:
+        write(latest.values())
+        return {}
+    except Exception as e:
+        if len(latest) == 1:
+            return {username: e for username in latest}
+    failures = {}
+    for username, update in latest.items():
+        try:
+            write([update])
+        except Exception as e:
+            failures[username] = e
+    return failures
+
+def _write_usage_updates(write_q, pending):
+    """Background writer: applies queued (username, row_index, uses_left, is_paid) updates to the sheet.
+
+    Transient failures stay pending and are retried with exponential backoff, up to SHEET_WRITE_ATTEMPTS
+    times. Permanent failures, and updates out of attempts, are logged and dropped from `pending`, so the
+    sheet (e.g. paid access granted there) isn't masked for the rest of the process.
+    """
+    retry_delay = 0
+    attempts = {} # username -> failed writes of their current update
+    while True:
+        batch = [write_q.get()]
+        while not write_q.empty():
+            batch.append(write_q.get_nowait())
+        # Bursts collapse into one API call, with only the latest update per user
+        latest = {username: (row_index, uses_left, is_paid) for username, row_index, uses_left, is_paid in batch}
+        failures = _write_usage_batch(latest)
+
+        retries = []
+        for username, (row_index, uses_left, is_paid) in latest.items():
+            if pending.get(username) != (uses_left, is_paid): # A newer update arrived meanwhile
+                continue
+            error = failures.get(username)
+            if error is None:
+                attempts.pop(username, None)
+                pending.pop(username, None)
+                fetch_user_row.clear(username) # This user's cached copy is now stale
+                continue
+            attempts[username] = attempts.get(username, 0) + 1
+            if _is_transient_sheet_error(error) and attempts[username] < SHEET_WRITE_ATTEMPTS:
+                logger.warning("Error saving user data to Google Sheet for %s (attempt %d), will retry: %s", username, attempts[username], error)
+                retries.append((username, row_index, uses_left, is_paid))
+            else:
+                logger.error("Giving up saving user data to Google Sheet for %s (uses_left=%s, is_paid=%s): %s", username, uses_left, is_paid, error)
+                attempts.pop(username, None)
+                pending.pop(username, None)
+
+        if retries:
+            retry_delay = min(max(1, retry_delay * 2), SHEET_RETRY_MAX_SEC)
+            time.sleep(retry_delay)
+            for update in retries:
+                write_q.put(update)
+        else:
+            retry_delay = 0
+
+@st.cache_resource
+def get_sheet_writer():
+    """Starts the background sheet writer once per process.
+
+    Returns (queue of updates to write, {username: (uses_left, is_paid)} of updates not yet written).
+    """
+    write_q = queue.Queue()
+    pending = {}
+    threading.Thread(target=_write_usage_updates, args=(write_q, pending), daemon=True).start()
+    return write_q, pending
+
+def queue_usage_update(username, uses_left, is_paid, email):
+    """Records a user's new usage immediately and writes it to the Google Sheet in the background,
+    so the UI doesn't wait on the Sheets API."""
+    row_index = st.session_state.get('_user_row_map', {}).get(username)
+    if row_index is None: # Row not known yet; find or append it synchronously
+        save_user_data_to_gsheets(username, uses_left, is_paid, email)
+        return
+    write_q, pending = get_sheet_writer()
+    pending[username] = (uses_left, is_paid)
+    write_q.put((username, row_index, uses_left, is_paid))
+
+
+# --- Scene Detection Worker Pool ---
+@st.cache_resource
+def get_executor():
+    """One thread pool for the whole server, reused across reruns.
+
+    Threads rather than processes: the pipeline spends its time in OpenCV/NumPy/Numba code that
+    releases the GIL, and threads skip process start-up and pickling each upload's bytes.
+    """
+    warm_up()
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+
+# --- Detection Settings ---
+# Sensitivity slider settings for each of core.DETECTION_METHODS
+SENSITIVITY_SLIDERS = {
+    "pixel": dict(
+        label="Pixel difference",
+        min_value=100000,
+        max_value=10000000,
+        value=3000000,
+        step=100000,
+        help="Increase this value if you're getting too many images for minor changes. Decrease if you're missing scene changes."
+    ),
+    "histogram": dict(
+        label="Histogram",
+        min_value=1,
+        max_value=100,
+        value=10,
+        step=1,
+        help="Percentage of the picture whose brightness has to change for a new scene. Increase if you're getting too many images, decrease if you're missing scene changes."
+    ),
+    "percentile": dict(
+        label="Brightness change (99th percentile)",
+        min_value=10,
+        max_value=80,
+        value=40,
+        step=1,
+        help="How much (0-255) the most-changed 1% of pixels must brighten or darken for a new scene. The same value works at any resolution."
+    ),
+    "dhash": dict(
+        label="Perceptual hash",
+        min_value=0,
+        max_value=32, # Of 64 bits; unrelated frames typically differ in about half, so 0-32 keeps the slider's steps fine where it matters
+        value=12,
+        step=1,
+        help="How many of the 64 bits of a frame's perceptual hash must differ for a new scene. Increase if you're getting too many images, decrease if you're missing scene changes."
+    ),
+}
+
+
+# --- Upload Previews ---
+@st.cache_data(max_entries=32, show_spinner=False)
+def get_thumbnail(digest, _video_bytes, name):
+    """First-frame JPEG preview of an upload, cached by content `digest` (the bytes themselves aren't hashed)."""
+    return thumbnail_jpeg(_video_bytes, name)
+
+
+# --- Scene Results Display ---
+# Upper bound on extracted-screenshot sets kept in a session's cache
+MAX_CACHED_RESULTS = 16
+
+def show_scene_results(video_name, scene_images):
+    """Renders one video's extracted scene JPEGs in a 4-column grid."""
+    saved_count = len(scene_images)
+    st.success(f"✅ Done! Saved {saved_count} scene-change screenshots for '{video_name}'.") # Keep this
+
+    # --- DISPLAYING RESULTS ---
+    if saved_count > 0:
+        st.markdown("#### Extracted Scenes:")
+        cols = st.columns(4) # Display images in 4 columns per row
+        for img_idx, img_bytes in enumerate(scene_images):
+            cols[img_idx % 4].image(img_bytes, caption=f"Scene {img_idx+1}", use_container_width=True)
+    else:
+        st.info(f"No significant scene changes detected for '{video_name}' with the current sensitivity.")
+
 
 # --- Custom Login/Registration Logic ---
 
@@ -100,8 +330,12 @@ if 'username' not in st.session_state:
 if 'current_view' not in st.session_state:
     st.session_state.current_view = 'login' # 'login' or 'register'
 
+# bcrypt cost for new hashes: 2^10 rounds (~4x faster than the default 12, still the OWASP minimum).
+# Each hash records its own cost, so existing cost-12 hashes keep verifying.
+BCRYPT_ROUNDS = 10
+
 def hash_password(password):
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode('utf-8')
 
 def check_password(password, hashed_password):
     return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
@@ -128,19 +362,23 @@ if st.session_state.authenticated:
         if st.button("Logout"):
             st.session_state.authenticated = False
             st.session_state.username = None
+            st.session_state.pop('user', None)
+            st.session_state.pop('_last_results', None)
             st.rerun()
 
-    # Load all user data from Google Sheets to get current user's status
-    # Ensure users_sheet is not None before attempting to load data
-    if users_sheet is not None:
-        all_users_data = load_user_data_from_gsheets()
-    else:
-        st.error("Google Sheets is not initialized. Cannot load user data.")
-        all_users_data = {} # Fallback to empty data to prevent further errors
-        st.stop()
-
-
-    current_user_data = all_users_data.get(username, None)
+    # A paid user's record is kept in session state after the first load, so their reruns don't touch the sheet.
+    # Free users are re-read on every rerun so that uses spent in another tab or session count against them, and a
+    # purchase made meanwhile shows up. The read is served from fetch_user_row's 60 s cache (invalidated only for
+    # the user whose row was written), so it reaches the Sheets API at most once a minute per user.
+    session_user_data = current_user_data = st.session_state.get('user')
+    if current_user_data is None or not current_user_data['is_paid']:
+        # Load the current user's data from Google Sheets to get their status
+        # Ensure users_sheet is not None before attempting to load data
+        if users_sheet is not None:
+            current_user_data = load_current_user(username) or session_user_data # Keep the last copy if the read failed
+        else:
+            st.error("Google Sheets is not initialized. Cannot load user data.")
+            st.stop()
 
     # Initialize user in Google Sheet if they are logging in for the very first time
     # (This catches users registered manually or through the new form if GSheets save failed on registration)
@@ -150,7 +388,8 @@ if st.session_state.authenticated:
         # Otherwise, adjust save_user_data_to_gsheets to match your sheet structure.
         user_email_for_gsheet = config['credentials']['usernames'][username].get('email', '')
         save_user_data_to_gsheets(username, initial_uses, False, user_email_for_gsheet) 
-        current_user_data = {'uses_left': initial_uses, 'is_paid': False}
+        current_user_data = {'uses_left': initial_uses, 'is_paid': False, 'email': user_email_for_gsheet}
+    st.session_state['user'] = current_user_data
 
     uses_left = current_user_data['uses_left']
     is_paid = current_user_data['is_paid']
@@ -161,22 +400,30 @@ if st.session_state.authenticated:
 
     # --- Conditional Access (Free Trial / Paid Access) ---
     if is_paid or uses_left > 0:
+        uses_info = st.empty() # Placeholder so the count can be updated in place after an extraction
         if not is_paid: # Only show uses left if not a paid user
-            st.info(f"You have {uses_left} free uses remaining.")
+            uses_info.info(f"You have {uses_left} free uses remaining.")
         else:
             st.sidebar.markdown("<p style='color: #28a745; font-weight: bold;'>You have unlimited access! 🎉</p>", unsafe_allow_html=True) # Changed from st.sidebar.success to st.sidebar.markdown for no green background
 
         # --- File Uploader (Your original code starts here) ---
         uploaded_files = st.file_uploader("Choose MP4 video files", type=["mp4"], accept_multiple_files=True)
 
+        # --- Detection Method ---
+        detection_method = st.selectbox(
+            "Detection method",
+            options=list(SENSITIVITY_SLIDERS),
+            format_func=lambda method: SENSITIVITY_SLIDERS[method]["label"],
+            help="Pixel difference reacts to any change in the picture. Histogram compares overall brightness distribution, so it ignores camera shake and small motion. Brightness change looks at the most-changed pixels, so it works the same at any resolution. Perceptual hash compares the coarse layout of the picture, so it ignores lighting changes."
+        )
+
         # --- Sensitivity Slider (Threshold) ---
+        # Each method scores frames in its own units, so it gets its own range (and keeps its own value)
+        slider_settings = {k: v for k, v in SENSITIVITY_SLIDERS[detection_method].items() if k != "label"}
         threshold = st.slider(
             "Adjust Sensitivity (Higher = Less Sensitive)",
-            min_value=100000,
-            max_value=10000000,
-            value=3000000,
-            step=100000,
-            help="Increase this value if you're getting too many images for minor changes. Decrease if you're missing scene changes."
+            key=f"threshold_{detection_method}",
+            **slider_settings
         )
 
         # --- Screenshot Duration Slider ---
@@ -189,6 +436,17 @@ if st.session_state.authenticated:
             help="Adjust the length of the video to analyze for scene changes (3 to 9 seconds)."
         )
 
+        # --- Advanced: Frame Sampling Stride ---
+        with st.expander("Advanced settings"):
+            frame_step = st.slider(
+                "Frame sampling stride",
+                min_value=1,
+                max_value=6,
+                value=2, # Default value
+                step=1,
+                help="Compare every Nth frame. Skipped frames aren't converted for analysis, so higher is faster but may miss very short scenes."
+            )
+
         # --- Display Previews for Uploaded Files ---
         if uploaded_files:
             st.markdown("---")
@@ -197,132 +455,118 @@ if st.session_state.authenticated:
             cols_per_row = 2 
             columns = st.columns(cols_per_row)
 
+            # Hash each upload once rather than on every rerun (e.g. each slider drag); kept only for current uploads
+            previous_digests = st.session_state.get('_upload_digests', {})
+            upload_digests = st.session_state['_upload_digests'] = {
+                uploaded_file.file_id: previous_digests.get(uploaded_file.file_id)
+                or hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).hexdigest()
+                for uploaded_file in uploaded_files
+            }
+
+            # A first-frame thumbnail rather than st.video, which would send every whole MP4 back to the browser
             for i, uploaded_file in enumerate(uploaded_files):
                 with columns[i % cols_per_row]:
                     st.text(f"{uploaded_file.name}")
-                    st.video(uploaded_file, format="video/mp4", start_time=0, width=400)
+                    try:
+                        thumbnail = get_thumbnail(upload_digests[uploaded_file.file_id], uploaded_file.getvalue(), uploaded_file.name)
+                    except ValueError as e: # Video could not be opened
+                        thumbnail = None
+                        st.warning(str(e))
+                    if thumbnail is not None:
+                        st.image(thumbnail)
 
             st.markdown("---")
 
             # --- Process Button ---
-            if st.button("Extract Scene Screenshots from All Uploaded Videos"):
+            extract_clicked = st.button("Extract Scene Screenshots from All Uploaded Videos")
+
+            # Screenshots extracted this session are kept per (video contents, duration, stride, method, sensitivity), so
+            # reruns show them again without reprocessing. Once a free user is out of uses this branch no longer runs;
+            # the results of their last extraction are then shown from '_last_results' below the purchase prompt.
+            scene_cache = st.session_state.setdefault('_scene_cache', {})
+            scene_keys = [
+                (upload_digests[uploaded_file.file_id], max_duration_sec, frame_step, detection_method, threshold)
+                for uploaded_file in uploaded_files
+            ]
+
+            if extract_clicked or any(scene_key in scene_cache for scene_key in scene_keys):
                 st.subheader("Processing Results:")
 
-                # Loop through each uploaded file to process it
-                for i, uploaded_file in enumerate(uploaded_files):
-                    st.markdown(f"### Processing: **{uploaded_file.name}**")
-
-                    # Create temporary directories for each video's processing
-                    with tempfile.TemporaryDirectory() as temp_dir:
-                        temp_video_path = os.path.join(temp_dir, uploaded_file.name)
-                        output_screenshots_dir = os.path.join(temp_dir, f"screenshots_output_{i}")
-                        os.makedirs(output_screenshots_dir, exist_ok=True)
-
-                        # Save uploaded file to a temporary location
-                        with open(temp_video_path, "wb") as f:
-                            f.write(uploaded_file.getbuffer())
-                        # Removed debug info message: st.info(f"Starting analysis for '{uploaded_file.name}'...")
-
-                        try:
-                            # --- MODIFIED: Video Processing using OpenCV ONLY, no MoviePy ---
-                            
-                            # OpenCV Video Capture
-                            cap = cv2.VideoCapture(temp_video_path)
-                            if not cap.isOpened():
-                                st.error(f"Could not open video file '{uploaded_file.name}'. Please check its format or if it's corrupted.")
-                                st.markdown("---")
-                                continue # Skip to the next uploaded file
-
-                            fps = cap.get(cv2.CAP_PROP_FPS)
-                            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-                            duration_video = total_frames / fps
-                            
-                            # Determine actual frames to process based on max_duration_sec
-                            frames_to_process = int(fps * max_duration_sec)
-                            if frames_to_process > total_frames:
-                                frames_to_process = total_frames # Don't go beyond actual video length
-
-                            # Removed debug text: st.text(f"Analyzing '{uploaded_file.name}' (first {min(duration_video, max_duration_sec):.1f} seconds / {frames_to_process} frames)...")
-                            
-                            success, prev_frame = cap.read()
-                            frame_count = 0
-                            saved_count = 0
-                            
-                            progress_bar = st.progress(0)
-                            status_text = st.empty()
-
-                            while success and frame_count < frames_to_process: # Only process up to max_duration_sec
-                                success, frame = cap.read()
-                                if not success:
-                                    break
-                                
-                                frame_count += 1
-                                
-                                # Update progress bar
-                                progress_value = min(1.0, frame_count / frames_to_process)
-                                progress_bar.progress(progress_value)
-                                status_text.text(f"Processing frame {frame_count} of {frames_to_process} for '{uploaded_file.name}'...") # Keep this for live feedback
-
-                                if frame_count == 1: # No previous frame for first one
-                                    prev_frame = frame
-                                    continue
-                                
-                                # Convert to grayscale for comparison
-                                gray_prev = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2GRAY)
-                                gray_curr = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-                                # Calculate pixel-wise difference (sum of absolute differences)
-                                diff = cv2.absdiff(gray_prev, gray_curr)
-                                total_pixel_difference = np.sum(diff)
-
-                                # Save if there's a big change
-                                if total_pixel_difference > threshold:
-                                    filename = f"{output_screenshots_dir}/scene_{saved_count:03}.jpg"
-                                    cv2.imwrite(filename, frame)
-                                    saved_count += 1
-                                    # For subsequent comparison, use the frame *after* the change
-                                    # to detect *new* changes, not small variations on the same scene.
-                                    prev_frame = frame 
-                                else:
-                                    prev_frame = frame # Always update prev_frame for continuous comparison
-
-                            cap.release()
-                            progress_bar.progress(1.0)
-                            status_text.text(f"Analysis complete for '{uploaded_file.name}'!") # Keep this for final feedback
-
-                            st.success(f"✅ Done! Saved {saved_count} scene-change screenshots for '{uploaded_file.name}'.") # Keep this
-
-                            # --- DISPLAYING RESULTS ---
-                            if saved_count > 0:
-                                st.markdown("#### Extracted Scenes:")
-                                cols = st.columns(4) # Display images in 4 columns per row
-                                image_files = sorted([f for f in os.listdir(output_screenshots_dir) if f.endswith('.jpg')])
-                                
-                                for img_idx, img_file in enumerate(image_files):
-                                    with open(os.path.join(output_screenshots_dir, img_file), "rb") as f:
-                                        img_bytes = f.read()
-                                    cols[img_idx % 4].image(img_bytes, caption=f"Scene {img_idx+1}", use_container_width=True)
-                            else:
-                                st.info(f"No significant scene changes detected for '{uploaded_file.name}' with the current sensitivity.")
-
-
-                            # IMPORTANT: After your actual screenshot code runs successfully for a free user,
-                            # decrement their usage.
-                            if not is_paid: # Only decrement for free users
-                                save_user_data_to_gsheets(username, uses_left - 1, is_paid)
-                                # Rerun to update uses_left count in the UI for the current user
-                                st.rerun() # Using st.rerun() now, not experimental
-                            else:
-                                st.success("Screenshot generated successfully!") # For paid users, no decrement needed
-
-
-                        except Exception as e:
-                            st.error(f"An error occurred during processing '{uploaded_file.name}': {e}")
-                        finally:
-                            pass # TemporaryDirectory handles cleanup
+                for uploaded_file, scene_key in zip(uploaded_files, scene_keys):
+                    if scene_key in scene_cache:
+                        st.markdown(f"### Results: **{uploaded_file.name}**")
+                        show_scene_results(uploaded_file.name, scene_cache[scene_key])
+                        st.markdown("---")
+
+                # Frame difference scores don't depend on the sensitivity slider, so keep them per
+                # (video contents, duration, stride, method) for this session; moving the slider then skips decode + diff.
+                diff_cache = st.session_state.setdefault('frame_diffs', {})
+
+                # Each video is independent, so analyze them in parallel worker threads.
+                # Streamlit calls stay on this thread; workers only return scores and JPEG bytes.
+                executor = get_executor()
+                futures = {}
+                if extract_clicked:
+                    for uploaded_file, scene_key in zip(uploaded_files, scene_keys):
+                        if scene_key in scene_cache:
+                            continue
+                        diff_key = scene_key[:4]
+                        future = executor.submit(process_one_video, uploaded_file.getvalue(), uploaded_file.name, threshold, max_duration_sec, frame_step, diff_cache.get(diff_key), detection_method)
+                        futures[future] = (uploaded_file, scene_key)
+
+                if futures:
+                    progress_bar = st.progress(0)
+                    status_text = st.empty()
+
+                extracted_any = False
+                for done_count, future in enumerate(as_completed(futures), start=1):
+                    uploaded_file, scene_key = futures[future]
+                    progress_bar.progress(done_count / len(futures))
+                    status_text.text(f"Finished {done_count} of {len(futures)} videos...")
+                    st.markdown(f"### Results: **{uploaded_file.name}**")
+
+                    try:
+                        diff_cache[scene_key[:4]], scene_images = future.result()
+                        scene_cache[scene_key] = scene_images
+                        while len(scene_cache) > MAX_CACHED_RESULTS: # Drop the oldest entries to bound memory
+                            scene_cache.pop(next(iter(scene_cache)))
+                        show_scene_results(uploaded_file.name, scene_images)
+                        extracted_any = True
+                        if is_paid:
+                            st.success("Screenshot generated successfully!")
+
+                    except ValueError as e: # Video could not be opened
+                        st.error(str(e))
+                    except Exception as e:
+                        st.error(f"An error occurred during processing '{uploaded_file.name}': {e}")
 
                     st.markdown("---") # Separator after each video's results
 
+                if futures:
+                    status_text.text("Analysis complete!")
+
+                # IMPORTANT: After your actual screenshot code runs successfully for a free user,
+                # decrement their usage: once per click, however many videos were uploaded.
+                # The count is updated in place rather than with st.rerun(), which would throw away
+                # the results of videos that hadn't finished yet.
+                # Charged against the latest count, not this page's copy, in case another session spent a use meanwhile.
+                if extracted_any and not is_paid:
+                    latest_user_data = load_current_user(username) or current_user_data
+                    if latest_user_data['is_paid']: # Purchased while the videos were processing: nothing to charge
+                        current_user_data['is_paid'] = True # Same dict as st.session_state['user']
+                        uses_info.empty()
+                    else:
+                        remaining_uses = max(0, latest_user_data['uses_left'] - 1)
+                        queue_usage_update(username, remaining_uses, False, current_user_data.get('email', ''))
+                        current_user_data['uses_left'] = remaining_uses # Same dict as st.session_state['user']
+                        uses_info.info(f"You have {remaining_uses} free uses remaining.")
+                        if remaining_uses == 0: # The uploader goes away on the next rerun, so keep what was just extracted
+                            st.session_state['_last_results'] = [
+                                (uploaded_file.name, scene_cache[scene_key])
+                                for uploaded_file, scene_key in zip(uploaded_files, scene_keys)
+                                if scene_key in scene_cache
+                            ]
+
 
     else: # User has no free uses left and is not a paid user
         st.error("You have used all your free uses.")
@@ -337,6 +581,16 @@ if st.session_state.authenticated:
             st.markdown(f'[<p style="text-align: center; color: white; background-color: #6264ff; padding: 10px; border-radius: 5px; text-decoration: none;">Click Here to Purchase Unlimited Access!</p>]({stripe_payment_link})', unsafe_allow_html=True)
             st.info("You will be redirected to a secure Stripe page to complete your purchase.") # Kept as user-facing info
 
+        # Results of the extraction that used the last free use, so they don't vanish on the next interaction
+        last_results = st.session_state.get('_last_results')
+        if last_results:
+            st.markdown("---")
+            st.subheader("Your Last Results:")
+            for video_name, scene_images in last_results:
+                st.markdown(f"### Results: **{video_name}**")
+                show_scene_results(video_name, scene_images)
+                st.markdown("---")
+
 # User is NOT authenticated, show login and registration forms
 else: 
     st.title("Welcome to Intro Frame!")
@@ -361,7 +615,7 @@ else:
                 st.error("Passwords do not match.")
             else:
                 # Hash the new password
-                hashed_new_password = bcrypt.hashpw(reg_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+                hashed_new_password = hash_password(reg_password)
                 
                 # IMPORTANT: Update config dictionary in memory (this is temporary for Streamlit Cloud)
                 # For persistence, we need to save to Google Sheets immediately.
@@ -398,8 +652,8 @@ else:
             user_creds = config['credentials']['usernames']
             if login_username in user_creds:
                 stored_hashed_password = user_creds[login_username]['password']
-                # Check if the stored password is a hash (starts with $2b$12$)
-                if stored_hashed_password.startswith('$2b$12$'):
+                # Check if the stored password is a bcrypt hash (starts with $2b$, followed by its cost)
+                if stored_hashed_password.startswith('$2b$'):
                     if bcrypt.checkpw(login_password.encode('utf-8'), stored_hashed_password.encode('utf-8')):
                         st.session_state.authenticated = True
                         st.session_state.username = login_username
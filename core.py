@@ -0,0 +1,480 @@
+"""Scene-change detection pipeline shared by the Streamlit app and scene_capture.py.
+
+Pure functions only (no Streamlit calls) so the work can run in worker threads. The heavy lifting
+is OpenCV, NumPy and a nogil Numba kernel, all of which release the GIL.
+"""
+import io
+import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError: # Numba is optional; frame_diffs falls back to OpenCV without it
+    njit = None
+
+try:
+    import decord
+except ImportError: # decord is optional; video files are then decoded with OpenCV
+    decord = None
+
+try:
+    import av
+except ImportError: # PyAV is optional; uploads are then written to a temp file and decoded by OpenCV
+    av = None
+
+# Frames are shrunk to about this many pixels before diffing; a scene-change check doesn't need full resolution.
+ANALYSIS_PIXELS = 320 * 180
+
+# After a saved scene, changes within this many seconds are ignored so one cut (or a fade) isn't captured repeatedly
+SCENE_COOLDOWN_SEC = 0.5
+
+# Scene-change metrics: "pixel" is the sum of absolute pixel differences in full-resolution units;
+# "histogram" is the percentage (0-100) of pixels that moved between buckets of a 64-bin gray histogram,
+# which ignores camera shake and small motion; "percentile" is the DELTA_PERCENTILE-th percentile of
+# the per-pixel brightness change (0-255); "dhash" is the Hamming distance (0-64) between 64-bit
+# difference hashes, which ignores lighting changes. The last three don't depend on resolution.
+DETECTION_METHODS = ("pixel", "histogram", "percentile", "dhash")
+HISTOGRAM_BINS = 64
+DELTA_PERCENTILE = 99
+
+# Quality of the in-memory JPEGs handed to the UI
+JPEG_QUALITY = 85
+
+# Preview thumbnails: first frame, at most this wide, at a lower quality than the extracted scenes
+THUMBNAIL_WIDTH = 400
+THUMBNAIL_JPEG_QUALITY = 70
+
+# OpenCV's transparent API runs cvtColor/resize as OpenCL kernels on cv2.UMat inputs (e.g. on an iGPU).
+# Only worth the upload/download when the default device is a GPU: a CPU OpenCL runtime (e.g. PoCL on a
+# headless server) is slower than the plain CPU path. Set INTROFRAME_OPENCL=0 to force the CPU path.
+def _opencl_gpu_available():
+    if os.environ.get("INTROFRAME_OPENCL", "1") == "0" or not cv2.ocl.haveOpenCL() or not cv2.ocl.useOpenCL():
+        return False
+    device = cv2.ocl.Device.getDefault()
+    return device.available() and bool(device.type() & cv2.ocl.Device_TYPE_GPU)
+
+USE_OPENCL = _opencl_gpu_available()
+
+# imencode releases the GIL, so scene hits are JPEG-encoded in parallel in this pool, shared by all videos
+# (separate from the app's per-video pool, whose workers wait on these encodes)
+_ENCODE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="jpeg")
+
+# Depth of the queues between pipeline stages; bounds how many full-resolution frames sit in RAM.
+PREFETCH_FRAMES = 8
+
+
+def warm_up():
+    """Compiles the Numba kernel (or loads it from the on-disk cache) so the first video doesn't pay for it."""
+    if njit is not None:
+        sad(np.zeros((2, 2), dtype=np.uint8), np.zeros((2, 2), dtype=np.uint8))
+
+
+def _read_frames(cap, frame_limit, frame_step, read_q, stop):
+    """Reader stage: puts every `frame_step`-th of the first `frame_limit` frames into `read_q`, then a None sentinel."""
+    try:
+        for frame_idx in range(frame_limit):
+            if stop.is_set():
+                break
+            if frame_idx % frame_step:
+                # grab() advances past frames we don't sample without converting them to BGR
+                if not cap.grab():
+                    break
+                continue
+            success, frame = cap.read()
+            if not success:
+                break
+            read_q.put(frame)
+    finally:
+        read_q.put(None)
+
+
+def _encode_jpeg(frame, color_conversion=None):
+    """Returns a BGR `frame` (converted with `color_conversion` first, if given) as JPEG bytes, or None on failure."""
+    if color_conversion is not None:
+        frame = cv2.cvtColor(frame, color_conversion)
+    ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buf.tobytes() if ok else None
+
+
+def _collect_jpegs(futures):
+    """Returns the results of _encode_jpeg `futures` in submission order, skipping failed encodes."""
+    return [jpeg for jpeg in (future.result() for future in futures) if jpeg is not None]
+
+
+if njit is not None:
+    # nogil so worker threads run it concurrently. Not parallel=True: Numba's own thread pool must not be
+    # entered from several Python threads at once, and a 320x180 frame is too small to benefit anyway.
+    @njit(fastmath=True, cache=True, nogil=True)
+    def sad(a, b):
+        """Sum of absolute differences of two uint8 images, fused into one pass with no temporaries."""
+        total = 0
+        for i in range(a.shape[0]):
+            row = 0
+            for j in range(a.shape[1]):
+                row += abs(np.int64(a[i, j]) - np.int64(b[i, j])) # widen before subtracting; uint8 would wrap
+            total += row
+        return total
+
+
+def frame_diffs(gray_frames):
+    """Returns the sum of absolute differences between each consecutive pair in a (T, H, W) uint8 stack."""
+    if njit is not None:
+        return np.array([sad(gray_frames[t], gray_frames[t + 1]) for t in range(len(gray_frames) - 1)], dtype=np.int64)
+    # One SIMD absdiff over the stacked frames (no int16 upcast), then OpenCV's row reduction
+    # with an int32 accumulator instead of np.sum widening every element to int64
+    pairs = len(gray_frames) - 1
+    if pairs < 1:
+        return np.zeros(0, dtype=np.int64)
+    diff = cv2.absdiff(gray_frames[1:].reshape(pairs, -1), gray_frames[:-1].reshape(pairs, -1))
+    return cv2.reduce(diff, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+
+
+def histogram_diffs(gray_frames):
+    """Returns the histogram difference (percent of pixels, 0-100) between each consecutive pair in a (T, H, W) uint8 stack."""
+    if len(gray_frames) < 2:
+        return np.zeros(0)
+    # One O(H*W) histogram pass per frame; the comparison itself is then only O(bins)
+    hists = np.stack([cv2.calcHist([gray], [0], None, [HISTOGRAM_BINS], [0, 256]).ravel() for gray in gray_frames])
+    # L1 counts every moved pixel twice (out of one bin, into another), hence 50 rather than 100
+    return np.abs(np.diff(hists, axis=0)).sum(axis=1) * (50.0 / gray_frames[0].size)
+
+
+def percentile_diffs(gray_frames):
+    """Returns the DELTA_PERCENTILE-th percentile absolute pixel difference (0-255) of each consecutive pair in a (T, H, W) uint8 stack."""
+    pairs = len(gray_frames) - 1
+    if pairs < 1:
+        return np.zeros(0, dtype=np.int64)
+    diff = cv2.absdiff(gray_frames[1:].reshape(pairs, -1), gray_frames[:-1].reshape(pairs, -1))
+    # A 256-bin histogram of the deltas finds the percentile in O(256) instead of sorting every pixel
+    rank = DELTA_PERCENTILE / 100 * diff.shape[1]
+    return np.array([np.searchsorted(np.cumsum(np.bincount(row, minlength=256)), rank) for row in diff], dtype=np.int64)
+
+
+def dhash_diffs(gray_frames):
+    """Returns the Hamming distance (0-64) between the dHashes of each consecutive pair in a (T, H, W) uint8 stack."""
+    if len(gray_frames) < 2:
+        return np.zeros(0, dtype=np.int64)
+    # dHash: shrink to 9x8 and keep one bit per horizontal neighbour pair, "is the right pixel brighter"
+    thumbs = np.stack([cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA) for gray in gray_frames])
+    bits = thumbs[:, :, 1:] > thumbs[:, :, :-1]
+    return (bits[1:] != bits[:-1]).sum(axis=(1, 2))
+
+
+def _score_frames(gray_frames, full_pixels, method):
+    """Returns the `method` scores of an analysis-size stack whose original frames had `full_pixels` pixels."""
+    if method == "histogram":
+        return histogram_diffs(gray_frames)
+    if method == "percentile":
+        return percentile_diffs(gray_frames)
+    if method == "dhash":
+        return dhash_diffs(gray_frames)
+    # Scale the pixel sums from the analysis size back to full resolution
+    return frame_diffs(gray_frames) * (full_pixels / gray_frames[0].size)
+
+
+def analysis_size(frame_width, frame_height):
+    """Returns the (width, height) to diff frames at: about ANALYSIS_PIXELS, same aspect ratio, never upscaled."""
+    scale = min(1.0, (ANALYSIS_PIXELS / (frame_width * frame_height)) ** 0.5)
+    return max(1, round(frame_width * scale)), max(1, round(frame_height * scale))
+
+
+def _shrink_gray(frame, small_size, dst, gray_full=None, color_conversion=cv2.COLOR_BGR2GRAY):
+    """Converts a BGR frame (or another layout, via `color_conversion`) to gray and resizes it into `dst`.
+
+    Returns the full-resolution gray scratch buffer, to be passed back in for the next frame.
+    """
+    if USE_OPENCL:
+        # Upload once, convert and shrink on the device, and download only the small result
+        dst[:] = cv2.resize(cv2.cvtColor(cv2.UMat(frame), color_conversion), small_size, interpolation=cv2.INTER_AREA).get()
+        return None
+    # Converting to gray before resizing is cheaper than resizing all three BGR channels
+    gray_full = cv2.cvtColor(frame, color_conversion, dst=gray_full)
+    cv2.resize(gray_full, small_size, dst=dst, interpolation=cv2.INTER_AREA)
+    return gray_full
+
+
+@contextmanager
+def _open_video(video_path):
+    """Yields an opened cv2.VideoCapture for `video_path`, released on exit."""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video file '{os.path.basename(video_path)}'. Please check its format or if it's corrupted.")
+    try:
+        yield cap
+    finally:
+        cap.release()
+
+
+def analyze_video(cap, max_duration_sec, frame_step=1, method="pixel"):
+    """Returns a difference score for every sampled frame in the first `max_duration_sec` seconds of `cap`.
+
+    Every `frame_step`-th frame is sampled, and diffs[i] compares sample i + 1 with sample i, in the
+    units of `method` (see DETECTION_METHODS) so it can be compared directly against the sensitivity threshold. The
+    result doesn't depend on the threshold, so callers can keep it and only re-run
+    scene_indices/encode_frames when the slider moves.
+    """
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    # Determine actual frames to process based on max_duration_sec, once, as an int
+    # (rounded so e.g. 29.97 fps * 4 s covers 120 frames rather than truncating to 119)
+    frames_to_process = min(int(round(fps * max_duration_sec)), total_frames) # Don't go beyond actual video length
+
+    # Decoding runs in a reader thread so it overlaps the grayscale conversion below.
+    # OpenCV releases the GIL in read/cvtColor/resize.
+    read_q = queue.Queue(maxsize=PREFETCH_FRAMES)
+    stop = threading.Event()
+    # +1 for the reference frame that precedes the analyzed ones
+    reader = threading.Thread(target=_read_frames, args=(cap, frames_to_process + 1, frame_step, read_q, stop), daemon=True)
+    reader.start()
+
+    try:
+        first_frame = read_q.get()
+        if first_frame is None:
+            return np.zeros(0)
+
+        # Small grayscale copies of every analyzed frame live in one contiguous (T, H, W) buffer
+        frame_height, frame_width = first_frame.shape[:2]
+        small_size = analysis_size(frame_width, frame_height)
+        sample_count = frames_to_process // frame_step + 1
+        gray_frames = np.empty((sample_count, small_size[1], small_size[0]), dtype=np.uint8)
+        # One full-resolution grayscale scratch buffer is reused for every frame instead of allocating per frame
+        gray_full = None
+        frame = first_frame
+        frame_count = 0
+        while frame is not None: # None once we reach max_duration_sec or the end of the video
+            gray_full = _shrink_gray(frame, small_size, gray_frames[frame_count], gray_full)
+            frame_count += 1
+            frame = read_q.get()
+    finally:
+        # Stop the reader (draining so it can't block on a full queue) before the caller releases the capture
+        stop.set()
+        while reader.is_alive():
+            try:
+                read_q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    # Score the whole clip in one vectorized call
+    return _score_frames(gray_frames[:frame_count], frame_width * frame_height, method)
+
+
+def scene_indices(diffs, threshold, frame_step=1, cooldown=0):
+    """Returns the frame indices of the samples whose difference from the previous sample exceeds `threshold`.
+
+    After each selected sample, the next `cooldown` samples are skipped.
+    """
+    selected = []
+    next_allowed = 0
+    for sample_idx in np.flatnonzero(diffs > threshold):
+        if sample_idx >= next_allowed:
+            selected.append(sample_idx)
+            next_allowed = sample_idx + 1 + cooldown
+    return (np.array(selected, dtype=np.int64) + 1) * frame_step
+
+
+def encode_frames(cap, frame_indices):
+    """Returns the frames of `cap` at `frame_indices` (ascending) encoded as JPEG bytes."""
+    if len(frame_indices) == 0:
+        return []
+
+    futures = []
+    wanted = set(int(idx) for idx in frame_indices)
+    for idx in range(max(wanted) + 1):
+        if idx in wanted:
+            success, frame = cap.read()
+            if not success:
+                break
+            # Encoded in the pool while we keep seeking to the next hit
+            futures.append(_ENCODE_POOL.submit(_encode_jpeg, frame))
+        elif not cap.grab(): # Skip frames we don't need without converting them to BGR
+            break
+    return _collect_jpegs(futures)
+
+
+def process_video(video_path, threshold, max_duration_sec, frame_step=1, diffs=None, method="pixel"):
+    """Finds scene changes in the first `max_duration_sec` seconds of a video.
+
+    `threshold` is in the units of `method` (see DETECTION_METHODS).
+    Pass `diffs` from an earlier call on the same video, duration, step and method to skip decoding and diffing.
+    Returns (diffs, scene_images), where scene_images are JPEG bytes.
+    """
+    # Prefer decord's batched access, then PyAV's scaled gray decode, then OpenCV
+    if decord is not None:
+        return _process_decord(video_path, threshold, max_duration_sec, frame_step, diffs, method)
+    if av is not None:
+        return _process_container(video_path, video_path, threshold, max_duration_sec, frame_step, diffs, method)
+
+    if diffs is None:
+        with _open_video(video_path) as cap:
+            diffs = analyze_video(cap, max_duration_sec, frame_step, method)
+
+    with _open_video(video_path) as cap:
+        cooldown = int(cap.get(cv2.CAP_PROP_FPS) * SCENE_COOLDOWN_SEC) // frame_step
+        return diffs, encode_frames(cap, scene_indices(diffs, threshold, frame_step, cooldown))
+
+
+def _open_decord(video_path, **kwargs):
+    """Returns a decord.VideoReader for `video_path`; kwargs (e.g. width/height) are passed through."""
+    try:
+        return decord.VideoReader(video_path, ctx=decord.cpu(0), **kwargs)
+    except (decord.DECORDError, RuntimeError):
+        raise ValueError(f"Could not open video file '{os.path.basename(video_path)}'. Please check its format or if it's corrupted.")
+
+
+def _process_decord(video_path, threshold, max_duration_sec, frame_step=1, diffs=None, method="pixel"):
+    """process_video using decord, which decodes a list of frame indices into one contiguous (N, H, W, 3) RGB batch."""
+    reader = _open_decord(video_path)
+    fps = reader.get_avg_fps()
+    if diffs is None:
+        frames_to_process = min(int(round(fps * max_duration_sec)), len(reader) - 1) # -1: the reference frame comes first
+        frame_height, frame_width = reader[0].shape[:2]
+        small_size = analysis_size(frame_width, frame_height)
+        sample_indices = list(range(0, frames_to_process + 1, frame_step))
+        gray_frames = np.empty((len(sample_indices), small_size[1], small_size[0]), dtype=np.uint8)
+        gray_full = None
+        # Full-size batches of PREFETCH_FRAMES, shrunk with INTER_AREA like the other decoders so scores
+        # (and so the scenes a threshold finds) don't depend on which decoder is installed
+        for start in range(0, len(sample_indices), PREFETCH_FRAMES):
+            batch = reader.get_batch(sample_indices[start:start + PREFETCH_FRAMES]).asnumpy()
+            for offset, frame in enumerate(batch):
+                gray_full = _shrink_gray(frame, small_size, gray_frames[start + offset], gray_full, cv2.COLOR_RGB2GRAY)
+        diffs = _score_frames(gray_frames, frame_width * frame_height, method)
+
+    cooldown = int(fps * SCENE_COOLDOWN_SEC) // frame_step
+    frame_indices = scene_indices(diffs, threshold, frame_step, cooldown)
+    if len(frame_indices) == 0:
+        return diffs, []
+    scene_frames = reader.get_batch(frame_indices.tolist()).asnumpy()
+    return diffs, _collect_jpegs([_ENCODE_POOL.submit(_encode_jpeg, frame, cv2.COLOR_RGB2BGR) for frame in scene_frames])
+
+
+@contextmanager
+def _open_container(source, name):
+    """Yields a PyAV container and its first video stream.
+
+    `source` is a file path, or the video's bytes, which are then decoded straight from memory.
+    """
+    try:
+        container = av.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        stream = container.streams.video[0]
+    except (av.FFmpegError, IndexError):
+        raise ValueError(f"Could not open video file '{os.path.basename(name)}'. Please check its format or if it's corrupted.")
+    stream.thread_type = "AUTO" # Let FFmpeg decode with frame/slice threads
+    try:
+        yield container, stream
+    finally:
+        container.close()
+
+
+def _stream_fps(stream):
+    return float(stream.average_rate or stream.guessed_rate or 0)
+
+
+def _analyze_container(container, stream, max_duration_sec, frame_step=1, method="pixel"):
+    """analyze_video for a PyAV stream.
+
+    Sampled frames are scaled and converted to gray by the decoder's swscale step, straight into the
+    analysis buffer, so there is no full-resolution BGR frame or separate cvtColor/resize.
+    """
+    frames_to_process = int(round(_stream_fps(stream) * max_duration_sec))
+    if stream.frames:
+        frames_to_process = min(frames_to_process, stream.frames) # Don't go beyond actual video length
+
+    gray_frames = None
+    frame_count = 0
+    for frame_idx, frame in enumerate(container.decode(stream)):
+        if frame_idx > frames_to_process: # +1 for the reference frame that precedes the analyzed ones
+            break
+        if frame_idx % frame_step:
+            continue
+        if gray_frames is None:
+            small_size = analysis_size(frame.width, frame.height)
+            sample_count = frames_to_process // frame_step + 1
+            gray_frames = np.empty((sample_count, small_size[1], small_size[0]), dtype=np.uint8)
+        gray_frames[frame_count] = frame.to_ndarray(width=small_size[0], height=small_size[1], format="gray", interpolation="AREA")
+        frame_count += 1
+
+    if gray_frames is None:
+        return np.zeros(0)
+    return _score_frames(gray_frames[:frame_count], frame.width * frame.height, method)
+
+
+def _encode_container(container, stream, frame_indices):
+    """encode_frames for a PyAV stream."""
+    if len(frame_indices) == 0:
+        return []
+
+    futures = []
+    wanted = set(int(idx) for idx in frame_indices)
+    last = max(wanted)
+    for frame_idx, frame in enumerate(container.decode(stream)):
+        if frame_idx in wanted:
+            futures.append(_ENCODE_POOL.submit(_encode_jpeg, frame.to_ndarray(format="bgr24")))
+        if frame_idx >= last:
+            break
+    return _collect_jpegs(futures)
+
+
+def _process_container(source, name, threshold, max_duration_sec, frame_step=1, diffs=None, method="pixel"):
+    """process_video using PyAV; `source` is a file path or the video's bytes."""
+    if diffs is None:
+        with _open_container(source, name) as (container, stream):
+            diffs = _analyze_container(container, stream, max_duration_sec, frame_step, method)
+
+    with _open_container(source, name) as (container, stream):
+        cooldown = int(_stream_fps(stream) * SCENE_COOLDOWN_SEC) // frame_step
+        return diffs, _encode_container(container, stream, scene_indices(diffs, threshold, frame_step, cooldown))
+
+
+@contextmanager
+def _temp_video(video_bytes, name):
+    """Yields the path of a temporary file holding `video_bytes`, for decoders that need a file."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        temp_video_path = os.path.join(temp_dir, os.path.basename(name))
+        with open(temp_video_path, "wb") as f:
+            f.write(video_bytes)
+        yield temp_video_path
+
+
+def process_one_video(video_bytes, name, threshold, max_duration_sec, frame_step=1, diffs=None, method="pixel"):
+    """process_video for an uploaded file.
+
+    With PyAV the upload is decoded directly from memory; otherwise it is written to a temporary
+    file for process_video first.
+    """
+    if av is not None:
+        return _process_container(video_bytes, name, threshold, max_duration_sec, frame_step, diffs, method)
+
+    with _temp_video(video_bytes, name) as temp_video_path:
+        return process_video(temp_video_path, threshold, max_duration_sec, frame_step, diffs, method)
+
+
+def thumbnail_jpeg(video_bytes, name):
+    """Returns the first frame of an uploaded video, at most THUMBNAIL_WIDTH wide, as JPEG bytes (None if it has no frames)."""
+    if av is not None:
+        with _open_container(video_bytes, name) as (container, stream):
+            frame = next(container.decode(stream), None)
+            if frame is None:
+                return None
+            # Scale while converting to BGR, in the same swscale pass
+            width = min(THUMBNAIL_WIDTH, frame.width)
+            first = frame.to_ndarray(width=width, height=max(1, round(frame.height * width / frame.width)), format="bgr24")
+    else:
+        with _temp_video(video_bytes, name) as temp_video_path, _open_video(temp_video_path) as cap:
+            success, first = cap.read()
+            if not success:
+                return None
+            if first.shape[1] > THUMBNAIL_WIDTH:
+                height = max(1, round(first.shape[0] * THUMBNAIL_WIDTH / first.shape[1]))
+                first = cv2.resize(first, (THUMBNAIL_WIDTH, height), interpolation=cv2.INTER_AREA)
+
+    ok, buf = cv2.imencode(".jpg", first, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_JPEG_QUALITY])
+    return buf.tobytes() if ok else None